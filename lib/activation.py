@@ -1,29 +1,49 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # vim: cc=80:
 
 
 import numpy as np
+from scipy.special import expit
 
-def sigmoid(z, prime=False):
+# NOTE: if out is given, the result is written to it instead of allocating a
+#       new array. out may be z itself.
+def sigmoid(z, prime=False, out=None):
+    """NOTE: expit is numerically stable for large |z|, no need to clip."""
     if prime:
-        return sigmoid(z)*(1-sigmoid(z))
+        return sigmoid_prime_a(sigmoid(z))
     else:
-        return 1.0 / (1.0 + np.exp(np.negative(np.clip(z, -50, 50))))
+        return expit(z, out=out)
 
-def tanh(z, prime=False):
+def tanh(z, prime=False, out=None):
     if prime:
         return 1.0 - np.square(tanh(z))
     else:
-        return np.tanh(z)
+        return np.tanh(z, out=out)
 
-def softplus(z, prime=False):
+def softplus(z, prime=False, out=None):
     """NOTE: this is a smoothed approximation of the ReLU
     activation function. It's easier to implement using
     numpy."""
     if prime:
         return sigmoid(z)
     else:
-        return np.log(1 + np.exp(np.clip(z, -50, 50)))
+        out = np.clip(z, -50, 50, out=out)
+        np.exp(out, out=out)
+        np.add(out, 1, out=out)
+        return np.log(out, out=out)
+
+
+# Derivatives expressed from the output a = f(z). These reuse the activations
+# computed by the forward pass instead of evaluating f(z) again.
+def sigmoid_prime_a(a):
+    return a * (1 - a)
+
+def tanh_prime_a(a):
+    return 1 - np.square(a)
+
+def softplus_prime_a(a):
+    """NOTE: sigmoid(z) = 1 - exp(-softplus(z))"""
+    return -np.expm1(np.negative(a))
 
 
 # Activation functions
@@ -35,14 +55,24 @@ class ActivationFunction():
             'softplus': softplus,
             }
 
+    output_derivatives = {
+            'sigmoid' : sigmoid_prime_a,
+            'tanh'    : tanh_prime_a,
+            'softplus': softplus_prime_a,
+            }
+
     def __init__(self,func='sigmoid'):
         self.function = ActivationFunction.available_functions[func]
+        self.output_derivative = ActivationFunction.output_derivatives[func]
         self.type = func
 
-    def __call__(self, z):
-        return self.function(z)
+    def __call__(self, z, out=None):
+        return self.function(z, out=out)
 
-    def derivative(self, z):
+    def derivative(self, z, a=None):
+        """If a = f(z) is already known, use it to avoid recomputing f(z)."""
+        if a is not None:
+            return self.output_derivative(a)
         return self.function(z, prime=True)
 
 
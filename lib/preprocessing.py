@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # vim: cc=80:
 
 
@@ -23,7 +23,7 @@ class Preprocessing:
         # Get array from file
         self.data = np.fromfile(filename, sep=' ')
         # Resize to match the file format
-        self.data = self.data.reshape((len(self.data)/26, 26))
+        self.data = self.data.reshape((len(self.data)//26, 26))
 
         if len(self.data) < self.count:
             logger.warning("Not enough lines [%d/%d] in file: %s " \
@@ -97,7 +97,7 @@ class Preprocessing:
         elif what == 'static+ES':
             _s = np.s_[COL_STATIC_E:]
         else:
-            raise("Unknown subset type")
+            raise Exception("Unknown subset type")
 
         self.data = np.delete(self.data, _s, 1)
 
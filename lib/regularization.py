@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # vim: cc=80:
 """
 Regularisation techniques are used to reduce overfitting.
@@ -48,3 +48,13 @@ class RegularizationFunction():
 
     def derivative(self, w):
         return self.function(w, self.lambda_, prime=True)
+
+    def apply(self, w, eta):
+        """Apply a gradient descent step of the regularization term to w
+        in place. For L2 this is a simple rescaling of the weights."""
+        if self.function is noreg:
+            return
+        elif self.function is weightdecay:
+            np.multiply(w, 1.0 - eta * self.lambda_ / len(w), out=w)
+        else:
+            np.subtract(w, eta * self.derivative(w), out=w)
@@ -1,15 +1,15 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # vim: cc=80:
 
 import os, fnmatch, re
 import numpy as np
 
-import preprocessing as prep
+from . import preprocessing as prep
 
 
 
 def vectorize_output(n, shape=(9, 1)):
-    v =  np.zeros(shape)
+    v =  np.zeros(shape, dtype=np.float32)
     v[n] = 1.0
     return v
 
@@ -23,30 +23,32 @@ def extract_datasets(basename='', size=60, sex=False, verbose=False):
     if verbose:
         print(" *** Training")
         inspect_dataset(tr_d, size=size)
-        print
+        print()
 
         print(" *** Validation")
         inspect_dataset(va_d, size=size)
-        print
+        print()
 
         print(" *** Testing")
         inspect_dataset(te_d, size=size)
-        print
+        print()
 
     return tr_d, va_d, te_d
 
 
 
 def _extract(dirname='train', size=60, sex=False, out_size=9):
-    """Takes a folder containing training data and returns a
-    list of tuples (input, output)"""
-    dataset = []
-    for num in xrange(1, out_size+1):
+    """Takes a folder containing training data and returns a tuple of
+    matrices (inputs, outputs) with one sample per row."""
+    inputs, outputs = [], []
+    for num in range(1, out_size+1):
         for file_ in get_filelist(dirname, num):
-            sample = extract_sample(file_, size=size, sex=sex)
-            dataset.append(sample)
+            features, labels = extract_sample(file_, size=size, sex=sex)
+            inputs.append(features.ravel())
+            outputs.append(labels.ravel())
 
-    return dataset
+    return np.array(inputs, dtype=np.float32), \
+            np.array(outputs, dtype=np.float32)
 
 
 
@@ -62,7 +64,8 @@ def extract_sample(file_, size=60, sex=False, out_size=9):
     num = int(re.search(r'(?=.*)[0-9](?=.*)', file_).group(0))
 
     # make a column of the whole array
-    features = x.data.reshape((len(x.data)*len(x.data[0]), 1) )
+    # NOTE: float32 to match the dtype of the Network weights
+    features = x.data.reshape((len(x.data)*len(x.data[0]), 1) ).astype(np.float32)
 
     if sex:
         if re.search(r'.*woman.*', file_):
@@ -90,14 +93,11 @@ def unpack_prediction(yhat):
 
 
 def inspect_dataset(dataset, size=60):
-    print("    * size : {}".format(len(dataset)))
-    print("    * input  shape: {} -> {}x{}".format(dataset[0][0].shape, dataset[0][0].shape[0]/size, size) )
-    if isinstance(dataset[0][1], np.ndarray):
-        print("    * output shape: {}".format(dataset[0][1].shape) )
-    else:
-        print("    * output shape: {}".format(type(dataset[0][1])) )
-
-    print("    * input type: {}".format(type(dataset[0][0])) )
+    inputs, outputs = dataset
+    print("    * size : {}".format(len(inputs)))
+    print("    * input  shape: {} -> {}x{}".format(inputs.shape[1:], inputs.shape[1]//size, size) )
+    print("    * output shape: {}".format(outputs.shape[1:]) )
+    print("    * input type: {}".format(inputs.dtype) )
 
 
 
@@ -242,7 +242,7 @@ def plot_confusion_matrix(basename, matrix, interpolation=None, style=None):
     # If classifying M/W
     labels = []
     if len(matrix[0]) > 9:
-        for l in xrange(1, len(matrix[0])+1):
+        for l in range(1, len(matrix[0])+1):
             if l <= 9:
                 l = '{:2}M'.format(l)
             else:
@@ -252,8 +252,8 @@ def plot_confusion_matrix(basename, matrix, interpolation=None, style=None):
         labels = range(1, len(matrix[0])+1)
 
     plt.tight_layout(pad=2)
-    plt.xticks(xrange(0, len(matrix[0])), labels)
-    plt.yticks(xrange(0, len(matrix[1])), labels)
+    plt.xticks(range(0, len(matrix[0])), labels)
+    plt.yticks(range(0, len(matrix[1])), labels)
     plt.grid(True)
     plt.title('Confusion Matrix')
 
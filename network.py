@@ -1,10 +1,10 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # vim: set cc=80:
 
 import os
 import yaml, tarfile
-import random
 import datetime
+import inspect
 import logging
 # this is not very pretty but meh..
 logging.basicConfig(format='%(levelname)s: %(message)s')
@@ -15,6 +15,7 @@ logger.setLevel(logging.INFO)
 
 # Use numpy and matices to speed up the processing
 import numpy as np
+from scipy.special import expit
 
 from lib.regularization import RegularizationFunction
 from lib.activation import ActivationFunction
@@ -25,12 +26,34 @@ from lib import utils
 # np.random.seed(1)
 
 
-class Network:
+class Network(object):
     options = {}
     options['cost'] = CostFunction.available_functions.keys()
     options['activation'] = ActivationFunction.available_functions.keys()
     options['regularization'] = RegularizationFunction.available_functions.keys()
 
+    def __new__(cls, *args, **kwargs):
+        """Return a specialized Network when one exists for the activation
+        and cost functions, see _specialized().
+
+        NOTE: copy and pickle call __new__ without arguments, in that case
+              the class is left untouched."""
+        if cls is Network and (args or kwargs):
+            # Resolve the arguments like __init__ would, defaults included
+            params = inspect.signature(Network.__init__).bind(
+                    None, *args, **kwargs)
+            params.apply_defaults()
+            cls = Network._specialized(params.arguments['activation'],
+                    params.arguments['cost'])
+        return super(Network, cls).__new__(cls)
+
+    @staticmethod
+    def _specialized(activation, cost):
+        """Return the Network class to use for an activation/cost pair."""
+        if activation == 'sigmoid' and cost == 'cross-entropy':
+            return SigmoidCrossEntropyNetwork
+        return Network
+
     def __init__(self, struct, \
             activation='sigmoid', cost='quadratic', regularization='none', \
             learning_rate=3.0, lambda_=0.1,
@@ -72,13 +95,46 @@ class Network:
         self.activation     = ActivationFunction(func=activation)
         self.cost           = CostFunction(func=cost)
 
-        self.a = [ np.random.randn(layer,1) for layer in struct ]
-        self.z = [ np.random.randn(layer,1) for layer in struct ]
+        # NOTE: float32 halves the memory traffic of every np.dot compared to
+        #       the default float64 and lets BLAS use sgemm.
+        self.a = [ np.random.randn(layer,1).astype(np.float32) for layer in struct ]
+        self.z = [ np.random.randn(layer,1).astype(np.float32) for layer in struct ]
 
-        self.biases  = [ np.random.randn(y, 1) for y in struct[1:] ]
-        self.weights = [ np.random.randn(y, x) / np.sqrt(x) \
+        self.biases  = [ np.random.randn(y, 1).astype(np.float32) \
+                        for y in struct[1:] ]
+        self.weights = [ (np.random.randn(y, x) / np.sqrt(x)).astype(np.float32) \
                         for x, y in zip(struct[:-1], struct[1:]) ]
 
+        self._init_buffers()
+
+
+    def _init_buffers(self):
+        """Allocate the gradient buffers used by backpropagation.
+
+        These are reused for every sample to avoid allocating a new set of
+        matrices each time the gradient is computed."""
+        self._nabla_b = [ np.zeros_like(b) for b in self.biases  ]
+        self._nabla_w = [ np.zeros_like(w) for w in self.weights ]
+
+        # z and activation buffers of feedforward, indexed by the number of
+        # samples and dtype of the input. See _layer_buffers().
+        self._layer_bufs = {}
+
+
+    def _layer_buffers(self, X):
+        """Return the (z, a) buffers of every layer for an input X.
+
+        There is one set of buffers per input width, so the mini-batches and
+        each evaluated dataset get their own and no allocation is done when
+        they are propagated again."""
+        dtype = np.result_type(X, *self.weights)
+        key = (X.shape[1], dtype)
+        if key not in self._layer_bufs:
+            z_bufs = [ np.empty((layer, X.shape[1]), dtype=dtype) \
+                    for layer in self.struct[1:] ]
+            a_bufs = [ np.empty_like(z) for z in z_bufs ]
+            self._layer_bufs[key] = (z_bufs, a_bufs)
+        return self._layer_bufs[key]
 
     def __repr__(self):
         """Returns a representation of the Network."""
@@ -98,7 +154,7 @@ class Network:
 
     def __call__(self, X):
         """Propagate input data through the network."""
-        return self.feedforward(X)
+        return self.feedforward(X).copy()
 
     def verbose_level(self, level):
         self.verbose = level
@@ -108,42 +164,34 @@ class Network:
             print(msg)
 
     def save(self, filename):
-        """Save the current state of the Network to a YAML file.
-        YAML format is convenient since it has no dependency on
-        python and can be edited by hand.
-        If the filename has a '.gz' extension, it will be compressed
-        automatically"""
+        """Save the current state of the Network to a compressed numpy
+        archive. The parameters are stored as raw binary, which is much
+        smaller and faster to load than the YAML format used before.
+        A '.npz' extension is appended if it is missing, the path actually
+        written is returned. load() accepts either name."""
+        if not filename.endswith('.npz'):
+            filename += '.npz'
+
         data = {
-                "struct"         : self.struct,
+                "struct"         : np.array(self.struct),
                 "eta"            : self.eta,
                 "lambda"         : self.lambda_,
 
                 "cost"           : self.cost.type,
                 "activation"     : self.activation.type,
                 "regularization" : self.regularization.type,
-
-                "weights"        : [ w.tolist() for w in self.weights ],
-                "biases"         : [ b.tolist() for b in self.biases  ],
                 }
+        for idx, (b, w) in enumerate(zip(self.biases, self.weights)):
+            data["biases_{}".format(idx)]  = b
+            data["weights_{}".format(idx)] = w
 
-        if filename.endswith('.gz'):
-            with tarfile.open(filename, 'w:gz') as tar:
-                tmp = filename.split('.gz')[0]
-                with open(tmp, 'wb') as f:
-                    f.write('# vim: set ft=yaml:\n')
-                    yaml.dump(data, f)
-                    tar.add(tmp)
-                    os.remove(tmp)
-        else:
-            with open(filename, 'wb') as f:
-                f.write('# vim: set ft=yaml:\n')
-                yaml.dump(data, f)
+        np.savez_compressed(filename, **data)
+        return filename
 
 
-    def _load_file(self, f):
-        data = yaml.load(f)
-
-        self.struct         = data['struct']
+    def _load_data(self, data):
+        self.struct         = tuple(data['struct'])
+        self.n_layers       = len(self.struct)
         self.eta            = data['eta']
         self.lambda_        = data['lambda']
 
@@ -153,13 +201,56 @@ class Network:
                 func=data['regularization'],
                 lambda_=self.lambda_)
 
-        self.biases  = [ np.array(b) for b in data['biases']  ]
-        self.weights = [ np.array(w) for w in data['weights'] ]
+        # The loaded functions may not match the ones we were built with
+        self.__class__ = Network._specialized(data['activation'], data['cost'])
+
+        self.biases  = [ np.array(b, dtype=np.float32) for b in data['biases']  ]
+        self.weights = [ np.array(w, dtype=np.float32) for w in data['weights'] ]
+        self._init_buffers()
+
+
+    def _load_npz(self, filename):
+        npz = np.load(filename, allow_pickle=False)
+        n = len(npz['struct']) - 1
+
+        data = {
+                "struct"         : [ int(x) for x in npz['struct'] ],
+                "eta"            : float(npz['eta']),
+                "lambda"         : float(npz['lambda']),
+
+                "cost"           : str(npz['cost']),
+                "activation"     : str(npz['activation']),
+                "regularization" : str(npz['regularization']),
+
+                "weights"        : [ npz['weights_{}'.format(i)] for i in range(n) ],
+                "biases"         : [ npz['biases_{}'.format(i)]  for i in range(n) ],
+                }
+        npz.close()
+        self._load_data(data)
+
+
+    def _load_file(self, f):
+        # NOTE: legacy files contain python tuples, not supported by safe_load
+        self._load_data(yaml.load(f, Loader=yaml.FullLoader))
 
 
     def load(self, filename):
-        """Load a Network configuration from a YAML file."""
-        if filename.endswith('.gz'):
+        """Load a Network configuration from a file written by save().
+
+        Legacy YAML files (optionally in a '.gz' archive) are still
+        supported.
+
+        NOTE: this may change the class of the Network in place, since the
+              loaded activation and cost functions decide whether it is a
+              SigmoidCrossEntropyNetwork or a generic Network."""
+        # NOTE: save() appends '.npz' to names that do not end with it
+        if not filename.endswith('.npz') and not os.path.exists(filename) \
+                and os.path.exists(filename + '.npz'):
+            filename += '.npz'
+
+        if filename.endswith('.npz'):
+            self._load_npz(filename)
+        elif filename.endswith('.gz'):
             with tarfile.open(filename, 'r:gz') as tar:
                 # NOTE: this only uses the first file of the archive!
                 f = tar.extractfile(tar.getmembers()[0])
@@ -170,22 +261,28 @@ class Network:
 
 
     def feedforward(self, X):
-        """Propagate input data through the network and store z and a values."""
+        """Propagate input data through the network and store z and a values.
+
+        NOTE: z and a are preallocated buffers, the returned output is
+              overwritten by the next call with an input of the same size."""
+        z_bufs, a_bufs = self._layer_buffers(X)
         act = X
-        z_list = []
-        a_list = [act]
 
-        for (b, w) in zip(self.biases, self.weights):
-            z = np.dot(w, act) + b
-            z_list.append(z)
-            act = self.activation(z)
-            a_list.append(act)
+        for (b, w, z, a) in zip(self.biases, self.weights, z_bufs, a_bufs):
+            np.dot(w, act, out=z)
+            np.add(z, b, out=z)
+            act = self._activate(z, out=a)
 
-        self.a = a_list
-        self.z = z_list
+        self.a = [X] + a_bufs
+        self.z = z_bufs
         return self.a[-1]
 
 
+    def _activate(self, z, out):
+        """Apply the activation function to z, writing the result in out."""
+        return self.activation(z, out=out)
+
+
     def train(self, tr_d, epochs, batch_size, \
             va_d=None, early_stop_n=None, \
             monitoring={'error':True, 'cost':True}):
@@ -203,7 +300,8 @@ class Network:
         Note that if batch_size=1, this performs a regular SGD.
 
         Parameters:
-         * tr_d         : Training set to be used,
+         * tr_d         : Training set to be used, a tuple of (X, Y) matrices
+                          with one sample per row,
          * epochs       : Maximum number of epochs,
          * batch_size   : Size of the mini-batch
          * va_d         : Validation set,
@@ -216,64 +314,81 @@ class Network:
 
         self.learn_time = datetime.datetime.now()
 
-        for i in xrange(epochs):
-            # Select a random mini batch in the training dataset
-            random.shuffle(tr_d)
+        tr_X, tr_Y = tr_d
+        n = len(tr_X)
 
-            # NOTE: `zip(*[iter(tr_d)]*batch_size)` is used to cut
-            #       tr_d into n batch_size elements.
-            for mini_batch in zip(*[iter(tr_d)]*batch_size):
-                # Create copies of the weights and biases and init to 0.
-                nabla_bC = np.multiply(np.array(self.biases,  copy=True), 0)
-                nabla_wC = np.multiply(np.array(self.weights, copy=True), 0)
+        for i in range(epochs):
+            # Select random mini batches in the training dataset
+            # NOTE: only the indices are shuffled, the dataset stays in place
+            #       and each mini-batch is gathered with a single slice.
+            perm = np.random.permutation(n)
 
-                for x, y in mini_batch:
-                    # Sum all the gradients over the mini-batch
-                    self.feedforward(x)
-                    nabla_bC_i, nabla_wC_i = self.backpropagation(y)
-                    nabla_bC = np.add(nabla_bC, nabla_bC_i)
-                    nabla_wC = np.add(nabla_wC, nabla_wC_i)
+            for j in range(0, n, batch_size):
+                # Propagate the whole mini-batch at once, one sample per
+                # column. backpropagation returns the gradients summed over
+                # the mini-batch.
+                X = tr_X[perm[j:j+batch_size]].T
+                Y = tr_Y[perm[j:j+batch_size]].T
+                self.feedforward(X)
+                nabla_bC, nabla_wC = self.backpropagation(Y)
 
                 # Update weights and biases
                 # NOTE: the weights and biases should be averaged over the size
                 #       of the mini-batch here but since it is done in the cost
                 #       function so there is no need for it.
-                self.biases  = [ b - self.eta * nb \
-                        for b, nb in zip(self.biases, nabla_bC) ]
-                self.weights = [ w - self.eta * (nw + \
-                    self.regularization.derivative(w) ) \
-                        for w, nw in zip(self.weights, nabla_wC) ]
+                # NOTE: updates are done in place, the gradients are scratch
+                #       buffers so they can be scaled by eta directly.
+                for b, nb in zip(self.biases, nabla_bC):
+                    np.multiply(nb, self.eta, out=nb)
+                    np.subtract(b, nb, out=b)
+                for w, nw in zip(self.weights, nabla_wC):
+                    # The regularization gradient is evaluated on the old
+                    # weights, so apply it before the cost gradient.
+                    self.regularization.apply(w, self.eta)
+                    np.multiply(nw, self.eta, out=nw)
+                    np.subtract(w, nw, out=w)
 
             self.log(1, "Epoch {:2d} training done.".format(i) )
 
+            # NOTE: a single forward pass per dataset, every value below is
+            #       derived from its output.
+            tr_n = len(tr_d[0])
+            tr_good, tr_cost_i = self._evaluate(tr_d, monitoring['cost'])
+            if va_d is not None:
+                va_n = len(va_d[0])
+                va_good, va_cost_i = self._evaluate(va_d, monitoring['cost'])
+                error_rate = 1.0 - float(va_good) / va_n
+
             self.log(2, " * Training   set accuracy   : {}/{}".format( \
-                    self.eval_accuracy(tr_d), len(tr_d)) )
-            self.log(2, " * Validation set accuracy   : {}/{}".format( \
-                    self.eval_accuracy(va_d), len(va_d)) )
+                    tr_good, tr_n) )
+            if va_d is not None:
+                self.log(2, " * Validation set accuracy   : {}/{}".format( \
+                        va_good, va_n) )
 
             if monitoring['error']:
+                tr_error_rate = 1.0 - float(tr_good) / tr_n
                 self.log(2, " * Training   set error rate : {:.3%}"\
-                        .format(self.eval_error_rate(tr_d)) )
-                tr_err.append(self.eval_error_rate(tr_d))
-                if va_d:
-                    error_rate = self.eval_error_rate(va_d)
+                        .format(tr_error_rate) )
+                tr_err.append(tr_error_rate)
+                if va_d is not None:
                     self.log(2, " * Validation set error rate : {:.3%}"\
                             .format(error_rate) )
                     va_err.append(error_rate)
 
             if monitoring['cost']:
                 self.log(2, " * Training   set cost       : {}"\
-                        .format(self.eval_cost(tr_d)) )
-                tr_cost.append(self.eval_cost(tr_d))
-                if va_d:
+                        .format(tr_cost_i) )
+                tr_cost.append(tr_cost_i)
+                if va_d is not None:
                     self.log(2, " * Validation set cost       : {}"\
-                            .format(self.eval_cost(va_d)) )
-                    va_cost.append(self.eval_cost(va_d))
+                            .format(va_cost_i) )
+                    va_cost.append(va_cost_i)
 
             # If we do not improve, stop training !
-            if self.eval_error_rate(va_d) < 0.01 or \
+            # NOTE: this needs a validation set
+            if va_d is not None and (error_rate < 0.01 or \
                     early_stop_n and i > early_stop_n and \
-                    error_rate - np.mean(va_err[-early_stop_n:]) < 0.05:
+                    error_rate - np.mean(va_err[-early_stop_n:]) < 0.05):
                         break
 
             # Print empty line if monitoring for easy reading
@@ -284,9 +399,6 @@ class Network:
         return tr_err, tr_cost, va_err, va_cost
 
 
-    # TODO: transform this so that it works with a matrix and not just a vector
-    #       this would be a little more efficient since it takes advantage full
-    #       advantage of numpy.
     def backpropagation(self, y):
         """Backpropagate the errors through the Network.
 
@@ -298,75 +410,129 @@ class Network:
         ref: https://en.wikipedia.org/wiki/Matrix_calculus
 
         Parameters:
-         * y : vector of labels
+         * y : matrix of labels, one sample per column, matching the input
+               of the last call to feedforward.
+
+        Each sample is a column of delta, so the products below sum the
+        gradients over the whole batch.
+
+        NOTE: the returned matrices are buffers owned by the Network, they are
+              overwritten by the next call.
         """
-        # Create copies of the weights and biases and init to 0.
-        nabla_bC = np.multiply(np.array(self.biases,  copy=True), 0)
-        nabla_wC = np.multiply(np.array(self.weights, copy=True), 0)
+        # Every layer is written below, no need to zero the buffers.
+        nabla_bC = self._nabla_b
+        nabla_wC = self._nabla_w
 
         # Before the for loop, delta = delta_L, the error on the last layer
         # NOTE: array[-1] refers to the last element.
-        if self.cost.type == 'cross-entropy':
-            # Since (for now?) this only works with sigmoid, remove act'
-            delta = self.cost.derivative(self.a[-1], y)
-        else:
-            delta = self.cost.derivative(self.a[-1], y) * \
-                    self.activation.derivative(self.z[-1])
+        delta = self._output_delta(y)
 
-        nabla_bC[-1] = delta
-        nabla_wC[-1] = np.dot(delta, self.a[-2].transpose())
+        np.sum(delta, axis=1, keepdims=True, out=nabla_bC[-1])
+        nabla_wC[-1][...] = np.dot(delta, self.a[-2].transpose())
 
         # Compute delta vectors and derivatives starting from layer (L-1)
-        for l in xrange(2, self.n_layers):
+        for l in range(2, self.n_layers):
             delta = np.dot(self.weights[-l+1].transpose(), delta) * \
-                    self.activation.derivative(self.z[-l])
+                    self.activation.derivative(self.z[-l], a=self.a[-l])
 
-            nabla_bC[-l] = delta
-            nabla_wC[-l] = np.dot(delta, self.a[-l-1].transpose())
+            np.sum(delta, axis=1, keepdims=True, out=nabla_bC[-l])
+            nabla_wC[-l][...] = np.dot(delta, self.a[-l-1].transpose())
 
         return (nabla_bC, nabla_wC)
 
 
+    def _output_delta(self, y):
+        """Return delta_L, the error on the last layer."""
+        if self.cost.type == 'cross-entropy':
+            # Since (for now?) this only works with sigmoid, remove act'
+            return self.cost.derivative(self.a[-1], y)
+        else:
+            return self.cost.derivative(self.a[-1], y) * \
+                    self.activation.derivative(self.z[-1], a=self.a[-1])
+
+
     def get_confusion(self, data):
         """Generate a confusion matrix on a given dataset. """
-        dim, _ = data[0][1].shape
+        X, Y = data
+        _, dim = Y.shape
         mat = np.zeros(shape=(dim,dim))
-        for (x, y) in data:
-            a = np.argmax(self.feedforward(x))
-            y = np.argmax(y)
-            mat[y][a] += 1.0
+        a = np.argmax(self.feedforward(X.T), axis=0)
+        y = np.argmax(Y, axis=1)
+        np.add.at(mat, (y, a), 1.0)
 
         return mat
 
+    def _accuracy(self, a, Y):
+        """Count correct predictions, given the network output a (one sample
+        per column) for the labels Y (one sample per row)."""
+        # Since y is a vector get the index of it's max
+        # this assumes a one-hot vector !!
+        return int(np.sum(np.argmax(a, axis=0) == np.argmax(Y, axis=1)))
+
+
+    def _cost(self, a, Y):
+        """Compute the total cost, given the network output a (one sample per
+        column) for the labels Y (one sample per row)."""
+        # Compute C0, the cost function alone
+        # NOTE: both cost functions sum over the columns, so evaluating the
+        #       whole dataset at once gives the sum of the per-sample costs.
+        total_cost = self.cost(a, Y.T)
+        # Add \Omega(h), the regularization term
+        total_cost += np.sum([ self.regularization(w) for w in self.weights ])
+
+        return total_cost
+
+
+    def _evaluate(self, data, cost=True):
+        """Return (accuracy, cost) on a given dataset with a single forward
+        pass. The cost is None if not requested."""
+        X, Y = data
+        a = self.feedforward(X.T)
+        return self._accuracy(a, Y), self._cost(a, Y) if cost else None
+
+
     def eval_accuracy(self, data):
         """Evaluate accuracy on a given dataset. """
-        count = 0
-        for (x, y) in data:
-            # Since y is a vector get the index of it's max
-            # this assumes a one-hot vector !!
-            if np.argmax(self.feedforward(x)) == np.argmax(y):
-                count += 1
-
-        return count
+        X, Y = data
+        return self._accuracy(self.feedforward(X.T), Y)
 
 
     def eval_error_rate(self, data):
         """Evaluate error rate on a given dataset. """
-        return 1.0 - float(self.eval_accuracy(data)) / len(data)
+        return 1.0 - float(self.eval_accuracy(data)) / len(data[0])
 
 
     def eval_cost(self, data):
         """Evaluate cost on a given dataset. """
-        # Compute C0, the cost function alone
-        total_cost = np.sum([ self.cost(self.feedforward(x), y) for (x, y) in data ])
-        # Add \Omega(h), the regularization term
-        total_cost += np.sum([ self.regularization(w) for w in self.weights ])
+        X, Y = data
+        return self._cost(self.feedforward(X.T), Y)
 
-        return total_cost
 
+class SigmoidCrossEntropyNetwork(Network):
+    """Network specialized for a sigmoid activation with a cross-entropy cost.
+
+    This is the configuration used by run.py. Network() returns an instance
+    of this class automatically, it only bypasses the generic activation and
+    cost functions on the hot path."""
 
+    def __init__(self, struct, activation='sigmoid', cost='cross-entropy', \
+            *args, **kwargs):
+        if activation != 'sigmoid' or cost != 'cross-entropy':
+            raise Exception("SigmoidCrossEntropyNetwork requires a sigmoid" +
+            " activation and a cross-entropy cost")
+        super(SigmoidCrossEntropyNetwork, self).__init__(struct, \
+                activation, cost, *args, **kwargs)
 
 
+    def _activate(self, z, out):
+        """Sigmoid inlined, bypassing the ActivationFunction dispatch."""
+        return expit(z, out=out)
 
 
+    def _output_delta(self, y):
+        """With a sigmoid output, the act' term of the cross-entropy
+        derivative cancels out: delta_L = (a - y) / n."""
+        a = self.a[-1]
+        delta = np.subtract(a, y)
+        return np.divide(delta, len(a), out=delta)
 
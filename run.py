@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # vim: cc=80:
 
 import os
@@ -27,8 +27,8 @@ training_data, validation_data, test_data = utils.extract_datasets(
         sex=sex_classification,
         )
 
-input_size  = len(training_data[0][0])
-output_size = len(training_data[0][1])
+input_size  = training_data[0].shape[1]
+output_size = training_data[1].shape[1]
 print(" ** Initializing Network...")
 net = network.Network(
         (input_size,output_size),
@@ -39,11 +39,14 @@ net = network.Network(
         lambda_        = 0.001,
         verbose        = net_verbose,
         )
-if os.path.exists('autoload.save.gz'):
-    print(" *** Found autoload, loading config...")
-    net.load('autoload.save.gz')
-    if net.struct[0] != input_size:
-        raise Exception("Autoload conf file does not match your dataset!")
+# NOTE: autoload.save.gz is the legacy YAML format
+for autoload in ('autoload.save.npz', 'autoload.save.gz'):
+    if os.path.exists(autoload):
+        print(" *** Found autoload, loading config...")
+        net.load(autoload)
+        if net.struct[0] != input_size:
+            raise Exception("Autoload conf file does not match your dataset!")
+        break
 print(net)
 print(" ** Starting training...")
 tr_err, tr_cost, va_err, va_cost = net.train(
@@ -72,9 +75,9 @@ tr_err, tr_cost, va_err, va_cost = net.train(
 
 
 
-print
-print
-print
+print()
+print()
+print()
 print(" ** Learned in : {} days, {} seconds and {} us".format(
     net.learn_time.days,
     net.learn_time.seconds,
@@ -85,29 +88,29 @@ print(" ** Learned in : {} days, {} seconds and {} us".format(
 
 if autosave:
     print(" ** Saving state of the Network...")
-    net.save('conf.save.gz')
+    net.save('conf.save.npz')
 
 
 
 if dosummary:
-    print
-    print " ** Summary : "
-    print "  ** Accuracy on train      dataset : {}/{} -> error: {:.3%}".format(
+    print()
+    print(" ** Summary : ")
+    print("  ** Accuracy on train      dataset : {}/{} -> error: {:.3%}".format(
             net.eval_accuracy(training_data),
-            len(training_data),
+            len(training_data[0]),
             net.eval_error_rate(training_data)
-            )
-    print "  ** Accuracy on validation dataset : {}/{} -> error: {:.3%}".format(
+            ))
+    print("  ** Accuracy on validation dataset : {}/{} -> error: {:.3%}".format(
             net.eval_accuracy(validation_data),
-            len(validation_data),
+            len(validation_data[0]),
             net.eval_error_rate(validation_data)
-            )
-    print "  ** Accuracy on test       dataset : {}/{} -> error: {:.3%}".format(
+            ))
+    print("  ** Accuracy on test       dataset : {}/{} -> error: {:.3%}".format(
             net.eval_accuracy(test_data),
-            len(test_data),
+            len(test_data[0]),
             net.eval_error_rate(test_data)
-            )
-    print
+            ))
+    print()
 
 
 
@@ -126,7 +129,7 @@ if evalsample:
     yhat = net(feat)
     print("    * prediction  : {}".format(utils.unpack_prediction(yhat)) )
     print("    * actual value: {}".format(utils.unpack_prediction(lab)) )
-    print
+    print()
 
 
 